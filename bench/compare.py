@@ -0,0 +1,45 @@
+"""
+Compare two bench.run reports stage by stage.
+
+    python -m bench.compare base.json head.json
+"""
+import argparse
+import json
+
+
+def compare(base: dict, head: dict) -> list[dict]:
+    rows = []
+    for name, new in head["stages"].items():
+        old = base["stages"].get(name)
+        if old is None or "error" in old or "error" in new:
+            continue
+        row = {"stage": name}
+        for key in ("throughput", "peak_rss_mb"):
+            row[key] = (old[key], new[key], new[key] / old[key] - 1)
+        for q in ("p50", "p99"):
+            if q in old["latency"] and q in new["latency"]:
+                a, b = old["latency"][q], new["latency"][q]
+                row[q] = (a, b, b / a - 1)
+        rows.append(row)
+    return rows
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("base")
+    parser.add_argument("head")
+    args = parser.parse_args(argv)
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+    print(f"base {base.get('commit')}  head {head.get('commit')}")
+    for row in compare(base, head):
+        cells = [f"{row.pop('stage'):<10}"]
+        for key, (a, b, delta) in row.items():
+            cells.append(f"{key} {a:.4g} -> {b:.4g} ({delta:+.1%})")
+        print("  ".join(cells))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,528 @@
+"""
+Offline benchmark for the capture/upload/training pipeline.
+
+Synthetic videos are served by a local Bilibili stand-in and uploaded to a
+fake Dropbox on local disk, so no network or credentials are needed. Every
+stage runs in a fresh process so its peak RSS is measured in isolation.
+
+    python -m bench.run --videos 8 --codec mp4v --width 640 --height 360 \\
+        --seconds 30 --out bench.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.stubs import FakeDropbox, StubServer
+from bench.synthetic import make_videos
+
+STAGES = (
+    "api",
+    "download",
+    "cut",
+    "upload",
+    "dataset",
+    "pipeline",
+    "pipeline_sink",
+    "scrap",
+)
+CHROME_BINARIES = (
+    "google-chrome",
+    "google-chrome-stable",
+    "chromium",
+    "chromium-browser",
+)
+
+
+def has_chrome() -> bool:
+    """
+    The scrap stage drives a real Chrome through selenium, so it only runs
+    by default when a Chrome or Chromium binary is on PATH.
+    """
+    return any(shutil.which(name) is not None for name in CHROME_BINARIES)
+
+
+DEFAULT_STAGES = STAGES if has_chrome() else STAGES[:-1]
+
+
+def percentiles(latencies: list[float]) -> dict:
+    if len(latencies) == 0:
+        return {}
+    ordered = sorted(latencies)
+
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        "mean": sum(ordered) / len(ordered),
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": ordered[-1],
+    }
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def _zip_dir(ctx: dict) -> str:
+    return os.path.join(ctx["workdir"], "zips")
+
+
+def _remote(ctx: dict) -> FakeDropbox:
+    return FakeDropbox(
+        os.path.join(ctx["workdir"], "dropbox"),
+        latency=ctx["dbx_latency"],
+        bandwidth=ctx["dbx_bandwidth"],
+    )
+
+
+def _cut_one(ctx: dict, bvid: str) -> str:
+    import stream
+
+    video_dir = os.path.join(ctx["workdir"], "cut", bvid)
+    os.makedirs(video_dir, exist_ok=True)
+    shutil.copyfile(
+        os.path.join(ctx["video_dir"], f"{bvid}.mp4"),
+        os.path.join(video_dir, f"{bvid}.mp4"),
+    )
+    asyncio.run(
+        stream.cut_videos(
+            video_dir,
+            ctx["image_size"],
+            interval=ctx["interval"],
+            variant_sizes=ctx["variants"],
+        )
+    )
+    zf_path = os.path.join(_zip_dir(ctx), f"{bvid}.zip")
+    os.makedirs(_zip_dir(ctx), exist_ok=True)
+    os.replace(os.path.join(video_dir, f"{bvid}.zip"), zf_path)
+    shutil.rmtree(video_dir)
+    return zf_path
+
+
+def _ensure_zips(ctx: dict):
+    for bvid in ctx["bvids"]:
+        if not os.path.exists(os.path.join(_zip_dir(ctx), f"{bvid}.zip")):
+            _cut_one(ctx, bvid)
+
+
+def _ensure_remote(ctx: dict):
+    import upload
+
+    _ensure_zips(ctx)
+    dbx = _remote(ctx)
+    for bvid in ctx["bvids"]:
+        remote_path = f"/MVFdataset/{bvid}.zip"
+        if not os.path.exists(dbx._local(remote_path)):
+            upload.upload_file(
+                dbx, os.path.join(_zip_dir(ctx), f"{bvid}.zip"), remote_path
+            )
+
+
+def stage_api(ctx: dict) -> dict:
+    import stream
+
+    async def run():
+        sessdata, cookies = await stream.get_sessdata()
+        limit = asyncio.Semaphore(ctx["concurrency"])
+        latencies = []
+
+        async def call(bvid: str):
+            async with limit:
+                start = time.perf_counter()
+                info = await stream.get_video_info(bvid, sessdata, cookies)
+                await stream.seek_stream(bvid, info["cid"], sessdata, cookies)
+                latencies.append(time.perf_counter() - start)
+
+        bvids = ctx["bvids"] * ctx["api_repeat"]
+        await asyncio.gather(*(call(bvid) for bvid in bvids))
+        return latencies
+
+    elapsed, latencies = _timed(asyncio.run, run())
+    return {"items": len(latencies), "elapsed": elapsed, "latencies": latencies}
+
+
+def stage_download(ctx: dict) -> dict:
+    import stream
+
+    data_dir = os.path.join(ctx["workdir"], "download")
+    os.makedirs(data_dir, exist_ok=True)
+    latencies = []
+    nbytes = 0
+    start = time.perf_counter()
+    for bvid in ctx["bvids"]:
+        latency, ok = _timed(
+            asyncio.run,
+            stream.download_videos([bvid], data_dir=data_dir, video_format="best"),
+        )
+        if not ok:
+            raise RuntimeError(f"download of {bvid} failed")
+        latencies.append(latency)
+    elapsed = time.perf_counter() - start
+    for name in os.listdir(data_dir):
+        nbytes += os.path.getsize(os.path.join(data_dir, name))
+    shutil.rmtree(data_dir)
+    return {
+        "items": len(latencies),
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "bytes": nbytes,
+    }
+
+
+def stage_cut(ctx: dict) -> dict:
+    shutil.rmtree(_zip_dir(ctx), ignore_errors=True)
+    latencies = []
+    start = time.perf_counter()
+    for bvid in ctx["bvids"]:
+        latency, _ = _timed(_cut_one, ctx, bvid)
+        latencies.append(latency)
+    elapsed = time.perf_counter() - start
+    nbytes = sum(
+        os.path.getsize(os.path.join(_zip_dir(ctx), name))
+        for name in os.listdir(_zip_dir(ctx))
+    )
+    return {
+        "items": len(latencies),
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "bytes": nbytes,
+    }
+
+
+def stage_upload(ctx: dict) -> dict:
+    import upload
+
+    _ensure_zips(ctx)
+    dbx = _remote(ctx)
+    shutil.rmtree(dbx.root, ignore_errors=True)
+    names = sorted(os.listdir(_zip_dir(ctx)))
+
+    def put(name: str) -> float:
+        latency, _ = _timed(
+            upload.upload_file,
+            dbx,
+            os.path.join(_zip_dir(ctx), name),
+            f"/MVFdataset/{name}",
+        )
+        return latency
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(ctx["concurrency"]) as executor:
+        latencies = list(executor.map(put, names))
+    elapsed = time.perf_counter() - start
+    list_latency, _ = _timed(upload.list_exists, dbx, "/MVFdataset")
+    return {
+        "items": len(latencies),
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "list_latency": list_latency,
+    }
+
+
+def stage_dataset(ctx: dict) -> dict:
+    from dataset import MVFDataset
+
+    _ensure_remote(ctx)
+    dataset = MVFDataset(ctx["dataset_size"], dbx=_remote(ctx))
+    latencies = []
+    frames = 0
+    start = time.perf_counter()
+    it = iter(dataset)
+    while True:
+        t0 = time.perf_counter()
+        try:
+            sample = next(it)
+        except StopIteration:
+            break
+        latencies.append(time.perf_counter() - t0)
+        frames += len(sample["frames"])
+    elapsed = time.perf_counter() - start
+    return {
+        "items": len(latencies),
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "frames": frames,
+    }
+
+
+def _pipeline_setup(ctx: dict, name: str):
+    import catalog
+    import stream
+
+    root = os.path.join(ctx["workdir"], name)
+    shutil.rmtree(root, ignore_errors=True)
+    data_dir = os.path.join(root, "data")
+    db_path = os.path.join(root, "bilibili.db")
+    os.makedirs(root)
+    asyncio.run(stream.setup(db_path, data_dir))
+    conn = catalog.connect(db_path)
+    catalog.add_videos(conn, ctx["bvids"])
+    conn.close()
+    dbx = FakeDropbox(
+        os.path.join(root, "dropbox"),
+        latency=ctx["dbx_latency"],
+        bandwidth=ctx["dbx_bandwidth"],
+    )
+    return data_dir, db_path, dbx
+
+
+def stage_pipeline(ctx: dict) -> dict:
+    import stream
+    import upload
+
+    data_dir, db_path, dbx = _pipeline_setup(ctx, "pipeline")
+    start = time.perf_counter()
+    capture, _ = _timed(
+        asyncio.run,
+        stream.main(
+            db_path,
+            data_dir,
+            image_size=ctx["image_size"],
+            interval=ctx["interval"],
+            video_format="best",
+            variant_sizes=ctx["variants"],
+        ),
+    )
+    store, _ = _timed(
+        upload.upload_all,
+        dbx,
+        data_dir,
+        "/MVFdataset/",
+        num_threads=ctx["concurrency"],
+        db_path=db_path,
+    )
+    elapsed = time.perf_counter() - start
+    stored = len(upload.list_exists(dbx, "/MVFdataset"))
+    return {
+        "items": stored,
+        "elapsed": elapsed,
+        "latencies": [],
+        "capture_seconds": capture,
+        "store_seconds": store,
+    }
+
+
+def stage_pipeline_sink(ctx: dict) -> dict:
+    """
+    Same as stage_pipeline but archives go straight to storage via UploadSink.
+    """
+    import stream
+    import upload
+
+    data_dir, db_path, dbx = _pipeline_setup(ctx, "pipeline_sink")
+    start = time.perf_counter()
+    with upload.UploadSink(
+        dbx,
+        "/MVFdataset/",
+        db_path=db_path,
+        num_threads=ctx["concurrency"],
+        max_buffer=ctx["sink_buffer"],
+        spool_dir=os.path.join(data_dir, "spool"),
+    ) as sink:
+        asyncio.run(
+            stream.main(
+                db_path,
+                data_dir,
+                image_size=ctx["image_size"],
+                interval=ctx["interval"],
+                video_format="best",
+                variant_sizes=ctx["variants"],
+                sink=sink,
+            )
+        )
+    elapsed = time.perf_counter() - start
+    stored = len(upload.list_exists(dbx, "/MVFdataset"))
+    return {
+        "items": stored,
+        "elapsed": elapsed,
+        "latencies": [],
+        "failed": len(sink.failed),
+    }
+
+
+def stage_scrap(ctx: dict) -> dict:
+    import catalog
+    import scrap
+
+    if not has_chrome():
+        raise RuntimeError(
+            f"scrap stage needs one of {', '.join(CHROME_BINARIES)} on PATH"
+        )
+    root = os.path.join(ctx["workdir"], "scrap")
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+    os.chdir(root)
+    latencies = []
+    start = time.perf_counter()
+    for url in ctx["page_urls"]:
+        latency, _ = _timed(scrap.login_videos, [url])
+        latencies.append(latency)
+    elapsed = time.perf_counter() - start
+    conn = catalog.connect("bilibili.db")
+    rows = len(catalog.video_aids(conn))
+    conn.close()
+    return {
+        "items": len(latencies),
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "rows": rows,
+    }
+
+
+def _child(name: str, ctx: dict, queue: mp.Queue):
+    os.environ["BILIBILI_API_ROOT"] = ctx["stub_root"]
+    os.environ["BILIBILI_VIDEO_URL"] = ctx["stub_root"] + "/video/{bvid}"
+    sys.path.insert(0, ctx["repo"])
+    import concurrency
+    import metrics
+
+    metrics.enable()
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            result = globals()[f"stage_{name}"](ctx)
+        latencies = result.pop("latencies")
+        result["throughput"] = result["items"] / result["elapsed"]
+        result["latency"] = percentiles(latencies)
+        result["peak_rss_mb"] = (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        )
+        result["limits"] = {
+            ctl.name: ctl.limit
+            for ctl in (
+                concurrency.BILIBILI_API,
+                concurrency.VIDEO_CDN,
+                concurrency.DROPBOX,
+            )
+        }
+        result["stages"] = {
+            sample["labels"]["stage"]: {
+                "count": sample["count"],
+                "seconds": sample["sum"],
+            }
+            for sample in metrics.STAGE_SECONDS.snapshot()
+        }
+        queue.put(result)
+    except Exception as e:
+        queue.put({"error": repr(e)})
+        raise
+
+
+def run_stage(name: str, ctx: dict) -> dict:
+    queue = mp.get_context("spawn").Queue()
+    proc = mp.get_context("spawn").Process(target=_child, args=(name, ctx, queue))
+    proc.start()
+    proc.join()
+    if queue.empty():
+        return {"error": f"stage exited with code {proc.exitcode}"}
+    return queue.get()
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: list[str] | None = None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--videos", type=int, default=8)
+    parser.add_argument("--codec", default="mp4v", help="OpenCV fourcc")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument("--seconds", type=float, default=30.0)
+    parser.add_argument("--fps", type=int, default=25)
+    parser.add_argument("--image-size", type=int, default=512)
+    parser.add_argument("--dataset-size", type=int, default=256)
+    parser.add_argument("--interval", type=float, default=5.0)
+    parser.add_argument(
+        "--variants", type=int, nargs="*", default=[], help="e.g. 256 128"
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--api-repeat", type=int, default=10)
+    parser.add_argument("--api-latency", type=float, default=0.0)
+    parser.add_argument("--dbx-latency", type=float, default=0.0)
+    parser.add_argument("--dbx-bandwidth", type=float, default=0.0)
+    parser.add_argument("--sink-buffer", type=int, default=256 * 1024 * 1024)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=DEFAULT_STAGES)
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("--out", default=None, help="write JSON here as well")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="mvf-bench-")
+    video_dir = os.path.join(workdir, "videos")
+    start = time.perf_counter()
+    bvids = make_videos(
+        video_dir,
+        args.videos,
+        codec=args.codec,
+        width=args.width,
+        height=args.height,
+        seconds=args.seconds,
+        fps=args.fps,
+    )
+    generate = time.perf_counter() - start
+
+    config = {k: v for k, v in vars(args).items() if k not in ("out", "workdir")}
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "config": config,
+        "generate_seconds": generate,
+        "stages": {},
+    }
+    with StubServer(
+        video_dir,
+        bvids,
+        width=args.width,
+        height=args.height,
+        seconds=args.seconds,
+        latency=args.api_latency,
+    ) as stub:
+        ctx = {
+            **config,
+            "repo": os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            "workdir": workdir,
+            "video_dir": video_dir,
+            "bvids": bvids,
+            "stub_root": stub.root,
+            "page_urls": stub.page_urls,
+        }
+        for name in args.stages:
+            print(f"running {name}", file=sys.stderr)
+            report["stages"][name] = run_stage(name, ctx)
+
+    if args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return report
+
+
+if __name__ == "__main__":
+    main()
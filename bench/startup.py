@@ -0,0 +1,145 @@
+"""
+Startup benchmark: import time of each module in a fresh interpreter, and
+time-to-first-sample of every DataLoader worker per start method.
+
+    python -m bench.startup --workers 4 --out startup.json
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.run import _ensure_remote, _remote, git_commit
+from bench.synthetic import make_videos
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ("metrics", "concurrency", "upload", "stream", "dataset")
+START_METHODS = ("spawn", "forkserver")
+
+IMPORT_SNIPPET = (
+    "import time; t = time.perf_counter(); import {module}; "
+    "print(time.perf_counter() - t)"
+)
+
+
+def import_time(module: str, repeat: int = 5) -> dict:
+    samples = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+            cwd=REPO,
+            capture_output=True,
+            text=True,
+        )
+        if out.returncode != 0:
+            return {"error": out.stderr.strip().splitlines()[-1]}
+        samples.append(float(out.stdout))
+    return {"min": min(samples), "median": statistics.median(samples)}
+
+
+def _first_samples(ctx: dict, num_workers: int, method: str, queue: mp.Queue):
+    import workers
+    from dataset import MVFDataset, dataloader
+
+    if method == "forkserver":
+        mp_context = workers.forkserver_context()
+    else:
+        mp_context = mp.get_context(method)
+    dataset = MVFDataset(ctx["dataset_size"], dbx=_remote(ctx))
+    start = time.perf_counter()
+    loader = dataloader(
+        dataset,
+        num_workers=num_workers,
+        batch_size=None,
+        multiprocessing_context=mp_context,
+        persistent_workers=False,
+    )
+    # the loader yields round-robin across workers, so the first
+    # `num_workers` samples are the first sample of each worker
+    arrivals = []
+    for _ in loader:
+        arrivals.append(time.perf_counter() - start)
+        if len(arrivals) == num_workers:
+            break
+    queue.put(arrivals)
+
+
+def first_samples(ctx: dict, num_workers: int, method: str) -> dict:
+    """
+    Runs in a fresh process so a forkserver started by an earlier measurement
+    cannot be reused.
+    """
+    spawn = mp.get_context("spawn")
+    queue = spawn.Queue()
+    proc = spawn.Process(
+        target=_first_samples, args=(ctx, num_workers, method, queue)
+    )
+    proc.start()
+    proc.join()
+    if queue.empty():
+        return {"error": f"exited with code {proc.exitcode}"}
+    arrivals = queue.get()
+    return {"per_worker": arrivals, "first": arrivals[0], "last": arrivals[-1]}
+
+
+def main(argv: list[str] | None = None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--image-size", type=int, default=512)
+    parser.add_argument("--dataset-size", type=int, default=256)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--modules", nargs="+", default=MODULES)
+    parser.add_argument(
+        "--methods", nargs="+", choices=START_METHODS, default=START_METHODS
+    )
+    parser.add_argument("--out", default=None, help="write JSON here as well")
+    args = parser.parse_args(argv)
+
+    report = {
+        "commit": git_commit(),
+        "time": time.time(),
+        "config": vars(args),
+        "import_seconds": {m: import_time(m, args.repeat) for m in args.modules},
+        "first_sample_seconds": {},
+    }
+
+    workdir = tempfile.mkdtemp(prefix="mvf-startup-")
+    try:
+        video_dir = os.path.join(workdir, "videos")
+        bvids = make_videos(video_dir, 2 * args.workers, seconds=args.seconds)
+        ctx = {
+            "workdir": workdir,
+            "video_dir": video_dir,
+            "bvids": bvids,
+            "image_size": args.image_size,
+            "dataset_size": args.dataset_size,
+            "interval": 5.0,
+            "variants": [],
+            "dbx_latency": 0.0,
+            "dbx_bandwidth": 0.0,
+        }
+        _ensure_remote(ctx)
+        for method in args.methods:
+            report["first_sample_seconds"][method] = first_samples(
+                ctx, args.workers, method
+            )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import json
+import os
+import shutil
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubServer:
+    """
+    Local stand-in for the Bilibili endpoints the pipeline touches: the wbi
+    nav, pagelist and playurl APIs, a video CDN serving files from
+    `video_dir`, and static listing pages for the selenium scrapers.
+    """
+
+    def __init__(
+        self,
+        video_dir: str,
+        bvids: list[str],
+        width: int = 640,
+        height: int = 360,
+        seconds: float = 30.0,
+        latency: float = 0.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.video_dir = video_dir
+        self.bvids = list(bvids)
+        self.width = width
+        self.height = height
+        self.seconds = seconds
+        self.latency = latency
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def root(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def page_urls(self) -> list[str]:
+        return [f"{self.root}/pages/{kind}.html" for kind in PAGE_KINDS]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def nav(self, query: dict) -> dict:
+        return {
+            "code": 0,
+            "data": {
+                "wbi_img": {
+                    "img_url": f"{self.root}/bfs/wbi/7cd084941338484aae1ad9425b84077c.png",
+                    "sub_url": f"{self.root}/bfs/wbi/4932caff0ff746eab6f01bf08b70ac45.png",
+                }
+            },
+        }
+
+    def pagelist(self, query: dict) -> dict:
+        bvid = query["bvid"][0]
+        return {
+            "code": 0,
+            "data": [
+                {
+                    "cid": self.bvids.index(bvid) + 1 if bvid in self.bvids else 0,
+                    "part": bvid,
+                    "duration": int(self.seconds),
+                    "dimension": {"width": self.width, "height": self.height},
+                }
+            ],
+        }
+
+    def playurl(self, query: dict) -> dict:
+        bvid = query["bvid"][0]
+        return {
+            "code": 0,
+            "data": {
+                "dash": {
+                    "video": [
+                        {
+                            "id": 32,
+                            "base_url": f"{self.root}/video/{bvid}",
+                            "width": self.width,
+                            "height": self.height,
+                        }
+                    ]
+                }
+            },
+        }
+
+    def page(self, kind: str) -> str:
+        links = [(bvid, f"{self.root}/video/{bvid}") for bvid in self.bvids]
+        return render_page(kind, links)
+
+    def _handler(self):
+        stub = self
+        routes = {
+            "/x/web-interface/nav": stub.nav,
+            "/x/player/pagelist": stub.pagelist,
+            "/x/player/playurl": stub.playurl,
+        }
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, status: int, body: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                if stub.latency > 0:
+                    time.sleep(stub.latency)
+                url = urlparse(self.path)
+                if url.path in routes:
+                    body = json.dumps(routes[url.path](parse_qs(url.query)))
+                    self._send(200, body.encode(), "application/json")
+                elif url.path.startswith("/video/"):
+                    bvid = url.path.split("/")[-1]
+                    path = os.path.join(stub.video_dir, f"{bvid}.mp4")
+                    if not os.path.exists(path):
+                        self.send_error(404)
+                        return
+                    with open(path, "rb") as f:
+                        self._send(200, f.read(), "video/mp4")
+                elif url.path.startswith("/pages/"):
+                    kind = os.path.splitext(os.path.basename(url.path))[0]
+                    if kind not in PAGE_KINDS:
+                        self.send_error(404)
+                        return
+                    self._send(200, stub.page(kind).encode(), "text/html")
+                else:
+                    self.send_error(404)
+
+            do_HEAD = do_GET
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+PAGE_KINDS = ("board", "cards", "rank", "related")
+
+
+def render_page(kind: str, links: list[tuple[str, str]]) -> str:
+    """
+    Static HTML with the same class structure the scrap.py parsers look for.
+    """
+    items = []
+    for title, href in links:
+        if kind == "board":
+            items.append(f'<a class="board-item-wrap" href="{href}" alt="{title}"></a>')
+        elif kind == "cards":
+            items.append(
+                f'<div class="video-card"><div class="video-card__content">'
+                f'<a href="{href}"></a></div><div class="video-card__info">'
+                f"<p>{title}</p></div></div>"
+            )
+        elif kind == "rank":
+            items.append(
+                f'<li class="rank-item"><div class="content"><div class="info">'
+                f'<a href="{href}" title="{title}">{title}</a></div></div></li>'
+            )
+        elif kind == "related":
+            items.append(
+                f'<div class="card-box"><div class="info">'
+                f'<a href="{href}" title="{title}">{title}</a></div></div>'
+            )
+    return "<html><body>" + "\n".join(items) + "</body></html>"
+
+
+@dataclass
+class FileMetadata:
+    name: str
+    path_display: str
+    size: int
+
+
+@dataclass
+class ListFolderResult:
+    entries: list
+    cursor: str
+    has_more: bool
+
+
+@dataclass
+class DownloadResponse:
+    content: bytes
+
+
+@dataclass
+class FakeDropbox:
+    """
+    Emulates the subset of `dropbox.Dropbox` used by upload.py and
+    dataset.py on top of a local directory. `latency` is added to every call
+    and `bandwidth` (bytes/s, 0 for unlimited) throttles transfers.
+    """
+
+    root: str
+    latency: float = 0.0
+    bandwidth: float = 0.0
+    page_size: int = 100
+    calls: dict = field(default_factory=dict)
+
+    def _local(self, remote_path: str) -> str:
+        return os.path.join(self.root, remote_path.lstrip("/"))
+
+    def _wait(self, name: str, nbytes: int = 0):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        delay = self.latency
+        if self.bandwidth > 0:
+            delay += nbytes / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+
+    def files_upload(self, f: bytes, path: str, mode=None, **kwargs):
+        self._wait("files_upload", len(f))
+        local = self._local(path)
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        tmp = local + ".part"
+        with open(tmp, "wb") as out:
+            out.write(f)
+        os.replace(tmp, local)
+        return FileMetadata(os.path.basename(path), path, len(f))
+
+    def files_list_folder(self, path: str, **kwargs) -> ListFolderResult:
+        self._wait("files_list_folder")
+        local = self._local(path)
+        names = sorted(os.listdir(local)) if os.path.isdir(local) else []
+        return self._page(path, names, 0)
+
+    def files_list_folder_continue(self, cursor: str) -> ListFolderResult:
+        self._wait("files_list_folder_continue")
+        path, offset = json.loads(cursor)
+        names = sorted(os.listdir(self._local(path)))
+        return self._page(path, names, offset)
+
+    def _page(self, path: str, names: list[str], offset: int) -> ListFolderResult:
+        end = offset + self.page_size
+        entries = [
+            FileMetadata(
+                name,
+                os.path.join(path, name),
+                os.path.getsize(os.path.join(self._local(path), name)),
+            )
+            for name in names[offset:end]
+        ]
+        return ListFolderResult(entries, json.dumps([path, end]), end < len(names))
+
+    def files_download(self, path: str):
+        with open(self._local(path), "rb") as f:
+            content = f.read()
+        self._wait("files_download", len(content))
+        meta = FileMetadata(os.path.basename(path), path, len(content))
+        return meta, DownloadResponse(content)
+
+    def files_download_to_file(self, download_path: str, path: str):
+        size = os.path.getsize(self._local(path))
+        self._wait("files_download_to_file", size)
+        shutil.copyfile(self._local(path), download_path)
+        return FileMetadata(os.path.basename(path), path, size)
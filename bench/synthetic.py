@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+
+
+def make_video(
+    path: str,
+    codec: str = "mp4v",
+    width: int = 640,
+    height: int = 360,
+    seconds: float = 30.0,
+    fps: int = 25,
+    seed: int = 0,
+):
+    """
+    Writes a synthetic clip of moving gradients plus noise, so the encoder
+    cannot collapse it to a handful of bytes.
+    """
+    import cv2
+
+    writer = cv2.VideoWriter(
+        path, cv2.VideoWriter_fourcc(*codec), fps, (width, height)
+    )
+    if not writer.isOpened():
+        raise RuntimeError(f"OpenCV cannot encode {codec!r} into {path}")
+    rng = np.random.default_rng(seed)
+    xs = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    ys = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    for t in range(int(seconds * fps)):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[..., 0] = (xs + ys + 3 * t) % 256
+        frame[..., 1] = (xs * 0.5 + 5 * t) % 256
+        frame[..., 2] = (ys * 0.5 + 7 * t) % 256
+        noise = rng.integers(0, 32, size=(height, width, 1), dtype=np.uint8)
+        writer.write(frame + noise)
+    writer.release()
+    return path
+
+
+def make_bvid(i: int) -> str:
+    import catalog
+
+    return catalog.to_bvid(i)
+
+
+def make_videos(
+    video_dir: str,
+    num_videos: int,
+    codec: str = "mp4v",
+    width: int = 640,
+    height: int = 360,
+    seconds: float = 30.0,
+    fps: int = 25,
+) -> list[str]:
+    """
+    Generates `num_videos` clips named `{bvid}.mp4` and returns their bvids.
+    """
+    os.makedirs(video_dir, exist_ok=True)
+    bvids = []
+    for i in range(num_videos):
+        bvid = make_bvid(i + 1)
+        make_video(
+            os.path.join(video_dir, f"{bvid}.mp4"),
+            codec=codec,
+            width=width,
+            height=height,
+            seconds=seconds,
+            fps=fps,
+            seed=i,
+        )
+        bvids.append(bvid)
+    return bvids
@@ -0,0 +1,281 @@
+"""
+The video catalog: one versioned DuckDB schema keyed by the integer aid.
+
+A BV id is a reversible encoding of the 64-bit aid, so tables store the aid
+(BIGINT) and convert at the edges with `to_aid`/`to_bvid`, or their
+vectorized forms `bvids_to_aids`/`aids_to_bvids` over NumPy arrays.
+"""
+import os
+import sys
+
+import numpy as np
+
+XOR_CODE = 23442827791579
+MASK_CODE = (1 << 51) - 1
+MAX_AID = 1 << 51
+BASE = 58
+ALPHABET = "FcwAPNKTMug3GV5Lj7EJnHpWsx4tb8haYeviqBz6rkCy12mUSDQX9RdoZf"
+BV_LENGTH = 12
+
+# BV ids swap characters 3<->9 and 4<->7 of the base-58 digits; the
+# permutation is its own inverse so it serves both directions
+_SWAP = np.array([0, 1, 2, 9, 7, 5, 6, 4, 8, 3, 10, 11])
+_ALPHABET_BYTES = np.frombuffer(ALPHABET.encode(), dtype=np.uint8)
+_DIGITS = np.full(256, -1, dtype=np.int64)
+_DIGITS[_ALPHABET_BYTES] = np.arange(BASE)
+_PREFIX = np.frombuffer(b"BV1", dtype=np.uint8)
+
+
+def to_aid(bvid: str) -> int:
+    chars = list(bvid)
+    if len(chars) != BV_LENGTH or bvid[:3] != "BV1":
+        raise ValueError(f"not a BV id: {bvid!r}")
+    for i in (3, 4):
+        j = _SWAP[i]
+        chars[i], chars[j] = chars[j], chars[i]
+    tmp = 0
+    for c in chars[3:]:
+        digit = ALPHABET.find(c)
+        if digit < 0:
+            raise ValueError(f"not a BV id: {bvid!r}")
+        tmp = tmp * BASE + digit
+    return (tmp & MASK_CODE) ^ XOR_CODE
+
+
+def to_bvid(aid: int) -> str:
+    chars = list("BV1000000000")
+    tmp = (MAX_AID | aid) ^ XOR_CODE
+    for i in range(BV_LENGTH - 1, 2, -1):
+        tmp, digit = divmod(tmp, BASE)
+        chars[i] = ALPHABET[digit]
+    for i in (3, 4):
+        j = _SWAP[i]
+        chars[i], chars[j] = chars[j], chars[i]
+    return "".join(chars)
+
+
+def _bv_bytes(bvids) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the BV ids as an (n, 12) uint8 matrix and a mask of which
+    entries are well-formed.
+    """
+    bvids = np.asarray(bvids, dtype=str)
+    try:
+        raw = bvids.astype(f"S{BV_LENGTH}")
+    except UnicodeEncodeError:
+        raw = np.char.encode(bvids, "ascii", "replace").astype(f"S{BV_LENGTH}")
+    chars = raw.view(np.uint8).reshape(-1, BV_LENGTH)
+    valid = np.char.str_len(bvids) == BV_LENGTH
+    valid &= (chars[:, :3] == _PREFIX).all(axis=1)
+    valid &= (_DIGITS[chars[:, 3:]] >= 0).all(axis=1)
+    return chars, valid
+
+
+def is_bvid(bvids) -> np.ndarray:
+    """
+    Boolean mask of the entries of `bvids` that are well-formed BV ids.
+    """
+    return _bv_bytes(bvids)[1]
+
+
+def bvids_to_aids(bvids) -> np.ndarray:
+    """
+    Vectorized `to_aid`: an array-like of BV id strings to an int64 array.
+    """
+    if len(bvids) == 0:
+        return np.empty(0, dtype=np.int64)
+    chars, valid = _bv_bytes(bvids)
+    if not valid.all():
+        raise ValueError("not all entries are BV ids, filter with is_bvid first")
+    digits = _DIGITS[chars[:, _SWAP][:, 3:]].astype(np.uint64)
+    tmp = np.zeros(len(chars), dtype=np.uint64)
+    for column in digits.T:
+        tmp = tmp * np.uint64(BASE) + column
+    return ((tmp & np.uint64(MASK_CODE)) ^ np.uint64(XOR_CODE)).astype(np.int64)
+
+
+def aids_to_bvids(aids) -> np.ndarray:
+    """
+    Vectorized `to_bvid`: an array-like of aids to an array of BV id strings.
+    """
+    aids = np.asarray(aids, dtype=np.uint64)
+    tmp = (aids | np.uint64(MAX_AID)) ^ np.uint64(XOR_CODE)
+    chars = np.empty((len(aids), BV_LENGTH), dtype=np.uint8)
+    chars[:, :3] = _PREFIX
+    for i in range(BV_LENGTH - 1, 2, -1):
+        chars[:, i] = _ALPHABET_BYTES[tmp % np.uint64(BASE)]
+        tmp //= np.uint64(BASE)
+    chars = np.ascontiguousarray(chars[:, _SWAP])
+    return chars.view(f"S{BV_LENGTH}").ravel().astype(str)
+
+
+def _columns(conn, table: str) -> list[str]:
+    return [
+        row[0]
+        for row in conn.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = ?",
+            [table],
+        ).fetchall()
+    ]
+
+
+def _v1_integer_keys(conn):
+    """
+    Replaces the legacy string-keyed tables (`bilibili` keyed by `bv` or, after
+    the old rename_column migration, `bvid`; `collected` keyed by `bvid`) with
+    aid-keyed ones, converting any existing rows.
+
+    The new tables leave out the legacy `bilibili.id` surrogate key and
+    `bilibili.url` column (the url is rebuilt from the bvid by
+    scrap.to_bilibili_url), and rows whose key is not a BV id. Nothing is
+    lost: the legacy tables are kept as `bilibili_legacy` and
+    `collected_legacy`, and the rows left behind are reported on stderr.
+    """
+    conn.execute(
+        "CREATE TABLE bilibili_v1 (aid BIGINT NOT NULL PRIMARY KEY, title VARCHAR)"
+    )
+    conn.execute(
+        """
+    CREATE TABLE collected_v1 (
+        aid BIGINT NOT NULL PRIMARY KEY,
+        cid INT,
+        signature VARCHAR(255),
+        timestamp TIMESTAMP,
+        length INT,
+        width INT,
+        height INT,
+    )
+    """
+    )
+    legacy = _columns(conn, "bilibili")
+    if len(legacy) > 0:
+        key = "bvid" if "bvid" in legacy else "bv"
+        frame = conn.execute(f"SELECT {key} AS bvid, title FROM bilibili").df()
+        _report_dropped("bilibili", len(frame), _insert(conn, "bilibili_v1", frame))
+        dropped = [column for column in legacy if column not in (key, "title")]
+        if len(dropped) > 0:
+            print(
+                f"catalog: columns {', '.join(dropped)} of bilibili are not "
+                "carried over",
+                file=sys.stderr,
+            )
+        conn.execute("ALTER TABLE bilibili RENAME TO bilibili_legacy")
+        print("catalog: legacy bilibili kept as bilibili_legacy", file=sys.stderr)
+    legacy = _columns(conn, "collected")
+    if len(legacy) > 0:
+        frame = conn.execute("SELECT * FROM collected").df()
+        _report_dropped("collected", len(frame), _insert(conn, "collected_v1", frame))
+        conn.execute("ALTER TABLE collected RENAME TO collected_legacy")
+        print("catalog: legacy collected kept as collected_legacy", file=sys.stderr)
+    conn.execute("ALTER TABLE bilibili_v1 RENAME TO bilibili")
+    conn.execute("ALTER TABLE collected_v1 RENAME TO collected")
+
+
+def _report_dropped(table: str, total: int, inserted: int):
+    if inserted < total:
+        print(
+            f"catalog: {total - inserted} of {total} rows of {table} are not "
+            "carried over because their key is not a BV id or is duplicated",
+            file=sys.stderr,
+        )
+
+
+def _insert(conn, table: str, frame) -> int:
+    """
+    Inserts a DataFrame keyed by a `bvid` column into an aid-keyed table.
+    Returns how many rows were valid and unique, i.e. offered for insertion.
+    """
+    frame = frame[is_bvid(frame["bvid"].fillna("").to_numpy())].copy()
+    frame.insert(0, "aid", bvids_to_aids(frame.pop("bvid").to_numpy()))
+    frame = frame.drop_duplicates("aid")
+    conn.register("_catalog_rows", frame)
+    columns = ", ".join(f'"{column}"' for column in frame.columns)
+    conn.execute(
+        f"INSERT INTO {table} ({columns}) SELECT {columns} FROM _catalog_rows "
+        "ON CONFLICT DO NOTHING"
+    )
+    conn.unregister("_catalog_rows")
+    return len(frame)
+
+
+MIGRATIONS = [_v1_integer_keys]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn) -> int:
+    if len(_columns(conn, "schema_version")) == 0:
+        return 0
+    return conn.execute("SELECT max(version) FROM schema_version").fetchone()[0] or 0
+
+
+def migrate(conn):
+    """
+    Brings the database up to SCHEMA_VERSION, one transaction per migration.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER)")
+    for version in range(schema_version(conn), SCHEMA_VERSION):
+        conn.begin()
+        try:
+            MIGRATIONS[version](conn)
+            conn.execute("INSERT INTO schema_version VALUES (?)", [version + 1])
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
+def connect(db_path: str = "bilibili.db"):
+    import duckdb
+
+    conn = duckdb.connect(db_path)
+    migrate(conn)
+    return conn
+
+
+def add_videos(conn, bvids, titles=None):
+    import pandas as pd
+
+    if titles is None:
+        titles = [None] * len(bvids)
+    frame = pd.DataFrame({"bvid": np.asarray(bvids, dtype=str), "title": titles})
+    _insert(conn, "bilibili", frame)
+
+
+def mark_collected(conn, bvids):
+    import pandas as pd
+
+    _insert(conn, "collected", pd.DataFrame({"bvid": np.asarray(bvids, dtype=str)}))
+
+
+def video_aids(conn) -> np.ndarray:
+    return conn.execute("SELECT aid FROM bilibili").fetchnumpy()["aid"]
+
+
+def collected_aids(conn) -> np.ndarray:
+    return conn.execute("SELECT aid FROM collected").fetchnumpy()["aid"]
+
+
+def todo_bvids(conn) -> np.ndarray:
+    """
+    BV ids of catalogued videos that have not been collected yet.
+    """
+    aids = conn.execute(
+        "SELECT aid FROM bilibili ANTI JOIN collected USING (aid) ORDER BY aid"
+    ).fetchnumpy()["aid"]
+    return aids_to_bvids(aids)
+
+
+def export_parquet(conn, out_dir: str):
+    """
+    Writes every catalog table to `{out_dir}/{table}.parquet`.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for table in ("bilibili", "collected"):
+        path = os.path.join(out_dir, f"{table}.parquet").replace("'", "''")
+        conn.execute(f"COPY {table} TO '{path}' (FORMAT PARQUET)")
+
+
+if __name__ == "__main__":
+    conn = connect("bilibili.db")
+    export_parquet(conn, "catalog")
+    conn.close()
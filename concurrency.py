@@ -0,0 +1,254 @@
+import asyncio
+import email.utils
+import functools
+import inspect
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+import metrics
+
+LIMIT = metrics.gauge("mvf_concurrency_limit", "Permitted in-flight requests.")
+INFLIGHT = metrics.gauge("mvf_concurrency_inflight", "Requests currently in flight.")
+RATE_LIMITED = metrics.counter(
+    "mvf_rate_limited_total", "Rate-limit responses seen per endpoint class."
+)
+
+
+class RateLimited(Exception):
+    """
+    Raised by a call wrapped in a controller slot when the remote asked us to
+    slow down. `retry_after` is in seconds, None if the server did not say.
+    """
+
+    def __init__(self, retry_after: float | None = None, message: str = ""):
+        super().__init__(message or f"rate limited, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def _wake_future(fut: asyncio.Future):
+    if not fut.done():
+        fut.set_result(None)
+
+
+class AIMDController:
+    """
+    Adaptive in-flight limit for one class of endpoint.
+
+    Every successful call adds `increase / limit` to the limit, i.e. roughly
+    +`increase` per round of `limit` calls, unless its latency exceeds
+    `latency_tolerance` times the best recent latency. A rate-limit response
+    multiplies the limit by `decrease` (at most once per `cooldown` seconds)
+    and blocks new calls until Retry-After has passed.
+
+    Slots can be taken from threads (`slot`, `call`) and from coroutines
+    (`aslot`, `acall`) on the same controller.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int = 4,
+        minimum: int = 1,
+        maximum: int = 64,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        cooldown: float = 1.0,
+        backoff: float = 5.0,
+        latency_tolerance: float = 3.0,
+    ):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.inflight = 0
+        self._lock = threading.Lock()
+        self._waiters = deque()
+        self._blocked_until = 0.0
+        self._last_decrease = -float("inf")
+        self._best_latency = None
+
+    @property
+    def permitted(self) -> int:
+        return max(self.minimum, int(self.limit))
+
+    def _take(self) -> float | None:
+        """
+        Takes a slot if one is free. Otherwise returns how long to wait, where
+        0 means until the next release or limit change.
+        """
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        if self.inflight < self.permitted:
+            self.inflight += 1
+            INFLIGHT.set(self.inflight, endpoint=self.name)
+            return None
+        return 0.0
+
+    def _wake(self):
+        waiters, self._waiters = self._waiters, deque()
+        for wake in waiters:
+            try:
+                wake()
+            except RuntimeError:
+                # the waiter's event loop has already been closed
+                pass
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                wait = self._take()
+                if wait is None:
+                    return
+                event = threading.Event()
+                self._waiters.append(event.set)
+            event.wait(wait or None)
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                wait = self._take()
+                if wait is None:
+                    return
+                fut = loop.create_future()
+                self._waiters.append(
+                    functools.partial(loop.call_soon_threadsafe, _wake_future, fut)
+                )
+            try:
+                await asyncio.wait_for(fut, wait or None)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self):
+        with self._lock:
+            self.inflight -= 1
+            INFLIGHT.set(self.inflight, endpoint=self.name)
+            self._wake()
+
+    def on_success(self, latency: float):
+        with self._lock:
+            best = self._best_latency
+            # slowly forget the best latency so a permanently slower path
+            # does not freeze the limit forever
+            self._best_latency = (
+                latency if best is None else min(latency, best * 1.01)
+            )
+            if best is not None and latency > self.latency_tolerance * best:
+                return
+            self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            LIMIT.set(self.limit, endpoint=self.name)
+            self._wake()
+
+    def on_rate_limited(self, retry_after: float | None = None):
+        RATE_LIMITED.inc(endpoint=self.name)
+        now = time.monotonic()
+        backoff = self.backoff if retry_after is None else retry_after
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, now + backoff)
+            if now - self._last_decrease >= self.cooldown:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self._last_decrease = now
+                LIMIT.set(self.limit, endpoint=self.name)
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        start = time.perf_counter()
+        try:
+            yield
+        except RateLimited as e:
+            self.on_rate_limited(e.retry_after)
+            raise
+        else:
+            self.on_success(time.perf_counter() - start)
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def aslot(self):
+        await self.acquire_async()
+        start = time.perf_counter()
+        try:
+            yield
+        except RateLimited as e:
+            self.on_rate_limited(e.retry_after)
+            raise
+        else:
+            self.on_success(time.perf_counter() - start)
+        finally:
+            self.release()
+
+    def call(self, fn, *args, retries: int = 5, **kwargs):
+        """
+        Runs `fn` inside a slot, retrying up to `retries` times on RateLimited.
+        The retry waits for Retry-After because the slot is blocked until then.
+        """
+        for attempt in range(retries + 1):
+            try:
+                with self.slot():
+                    return fn(*args, **kwargs)
+            except RateLimited:
+                if attempt == retries:
+                    raise
+
+    async def acall(self, fn, *args, retries: int = 5, **kwargs):
+        for attempt in range(retries + 1):
+            try:
+                async with self.aslot():
+                    return await fn(*args, **kwargs)
+            except RateLimited:
+                if attempt == retries:
+                    raise
+
+    def limited(self, retries: int = 5):
+        """
+        Decorator version of `call`/`acall` for both plain and async functions.
+        """
+
+        def decorator(fn):
+            if inspect.iscoroutinefunction(fn):
+
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    return await self.acall(fn, *args, retries=retries, **kwargs)
+
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                return self.call(fn, *args, retries=retries, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+
+BILIBILI_API = AIMDController("bilibili_api", initial=4, maximum=32)
+# a CDN call downloads a whole batch of videos of any length, so its latency
+# says nothing about congestion; only rate-limit responses shrink this limit
+VIDEO_CDN = AIMDController(
+    "video_cdn", initial=4, maximum=16, latency_tolerance=float("inf")
+)
+DROPBOX = AIMDController("dropbox", initial=8, maximum=64)
@@ -1,4 +1,6 @@
-from typing import Any
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any
 from torch.utils.data import (
     MapDataPipe,
     Dataset,
@@ -7,33 +9,47 @@ from torch.utils.data import (
     DataChunk,
     functional_datapipe,
 )
-import datasets
 import zipfile
-import glob
 import numpy as np
 import os
 from torch import Tensor
 import torch
 from PIL import Image
-import torchvision.transforms.v2.functional as TF
 import io
-import webdataset as wds
-import dropbox
-from upload import list_exists
+import functools
+from upload import list_exists, dbx_call, get_client
 import torch.utils.data.datapipes as dp
+import metrics
+import workers
+
+if TYPE_CHECKING:
+    import dropbox
+
+# torchvision and dropbox are imported on first use, and Dropbox clients are
+# created lazily per process (upload.get_client), so that DataLoader workers
+# start without paying for imports or auth they may never need. Workers never
+# fall back to the interactive OAuth flow: there is no terminal to answer it.
 
 
 @functional_datapipe("mvf_path")
 class _MVFPathPipe(IterDataPipe, IterableDataset):
-    def __init__(self, **kwargs):
+    def __init__(self, dbx: dropbox.Dropbox | None = None, **kwargs):
         super().__init__()
-        self.dbx = dropbox.Dropbox(
-            oauth2_refresh_token=os.environ["DBX_REFRESH_TOKEN"],
-            oauth2_access_token=os.environ["DBX_ACCESS_TOKEN"],
-            app_key=os.environ["DBX_APP_KEY"],
-            app_secret=os.environ["DBX_APP_SECRET"],
-        )
-        self.filenames = np.asarray(list_exists(self.dbx, "/MVFdataset", ".zip"))
+        self._dbx = dbx
+        self._filenames = None
+
+    @property
+    def dbx(self) -> dropbox.Dropbox:
+        return self._dbx or get_client(interactive=False)
+
+    @property
+    def filenames(self) -> np.ndarray:
+        if self._filenames is None:
+            # sorted so that every worker shards the same order
+            self._filenames = np.asarray(
+                sorted(list_exists(self.dbx, "/MVFdataset", ".zip"))
+            )
+        return self._filenames
 
     def __getitem__(self, index):
         return self.filenames[index]
@@ -48,30 +64,51 @@ class _MVFPathPipe(IterDataPipe, IterableDataset):
 
 @functional_datapipe("dbx_download")
 class _DBXDownloader(IterDataPipe, IterableDataset):
-    def __init__(self, datapipe: IterDataPipe, **kwargs):
+    def __init__(
+        self,
+        datapipe: IterDataPipe,
+        dbx: dropbox.Dropbox | None = None,
+        image_size: int | None = None,
+        **kwargs,
+    ):
         super().__init__()
         self.datapipe = datapipe
-        self.dbx = dropbox.Dropbox(
-            oauth2_refresh_token=os.environ["DBX_REFRESH_TOKEN"],
-            oauth2_access_token=os.environ["DBX_ACCESS_TOKEN"],
-            app_key=os.environ["DBX_APP_KEY"],
-            app_secret=os.environ["DBX_APP_SECRET"],
-        )
+        self.image_size = image_size
+        self._dbx = dbx
+
+    @property
+    def dbx(self) -> dropbox.Dropbox:
+        return self._dbx or get_client(interactive=False)
 
     def __iter__(self):
         return len(self.datapipe)
 
     def download(self, remote_path: str):
+        import torchvision.transforms.v2.functional as TF
+
         bv = os.path.basename(remote_path).split(".")[0]
-        meta, resp = self.dbx.files_download(os.path.join("/MVFdataset", remote_path))
+        with metrics.timer("dataset_download"):
+            meta, resp = dbx_call(
+                self.dbx.files_download, os.path.join("/MVFdataset", remote_path)
+            )
         imgs = []
-        with zipfile.ZipFile(io.BytesIO(resp.content), "r") as zf:
-            for name in sorted(zf.namelist()):
-                if name.endswith(".jpg"):
+        with metrics.timer("dataset_decode"), zipfile.ZipFile(
+            io.BytesIO(resp.content), "r"
+        ) as zf:
+            names = zf.namelist()
+            # prefer the pre-resized variant written at capture time, if any
+            prefix = f"{self.image_size}/"
+            if not any(name.startswith(prefix) for name in names):
+                prefix = ""
+            for name in sorted(names):
+                if not name.startswith(prefix) or "/" in name[len(prefix) :]:
+                    continue
+                if name.endswith((".jpg", ".jpeg")):
                     img = Image.open(io.BytesIO(zf.read(name))).convert("RGB")
                     img = TF.pil_to_tensor(img)
                     imgs.append(img)
-        imgs = torch.stack(imgs)
+            imgs = torch.stack(imgs)
+        metrics.count("dataset_decode", len(imgs))
         return {"bv": bv, "frames": imgs}
 
     def __iter__(self):
@@ -89,17 +126,28 @@ class MVFDataset(IterDataPipe, IterableDataset):
         self._mvfpaths = _MVFPathPipe(**kwargs)
         self.image_size = image_size
         self.transform = transform
+        # no deepcopy, so the lazily fetched file listing is kept across epochs
         self.dp = (
-            dp.iter.IterableWrapper(self._mvfpaths)
+            dp.iter.IterableWrapper(self._mvfpaths, deepcopy=False)
             .sharding_filter()
             .shuffle()
-            .dbx_download()
+            .dbx_download(dbx=kwargs.get("dbx"), image_size=image_size)
             .map(self.resize)
-            .map(transform if transform is not None else lambda x: x)
         )
+        # lambdas cannot be pickled into spawned/forkserver workers
+        if transform is not None:
+            self.dp = self.dp.map(transform)
 
     def resize(self, image: Tensor) -> Tensor:
-        image["frames"] = TF.resize(image["frames"], self.image_size, antialias=True)
+        import torchvision.transforms.v2.functional as TF
+
+        if min(image["frames"].shape[-2:]) == self.image_size:
+            metrics.count("dataset_resize_skipped")
+            return image
+        with metrics.timer("dataset_resize"):
+            image["frames"] = TF.resize(
+                image["frames"], self.image_size, antialias=True
+            )
         return image
 
     def __len__(self):
@@ -111,3 +159,24 @@ class MVFDataset(IterDataPipe, IterableDataset):
 
     def __getitem__(self, index) -> Any:
         return NotImplementedError
+
+
+def dataloader(dataset: Dataset, num_workers: int = 4, **kwargs):
+    """
+    DataLoader whose worker processes fork from a forkserver that has already
+    imported the dataset stack (see workers.forkserver_context), and are kept
+    alive between epochs. Each worker exports its own metrics to
+    METRICS_JSONL (see metrics.worker_init_fn).
+    """
+    if num_workers > 0:
+        kwargs.setdefault("multiprocessing_context", workers.forkserver_context())
+        kwargs.setdefault("persistent_workers", True)
+        kwargs.setdefault(
+            "worker_init_fn",
+            functools.partial(
+                metrics.worker_init_fn,
+                enabled=metrics.ENABLED,
+                path=os.environ.get("METRICS_JSONL"),
+            ),
+        )
+    return torch.utils.data.DataLoader(dataset, num_workers=num_workers, **kwargs)
@@ -0,0 +1,396 @@
+import bisect
+import functools
+import inspect
+import json
+import math
+import multiprocessing.util
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    math.inf,
+)
+
+ENABLED = os.environ.get("METRICS", "0") not in ("", "0", "false")
+
+
+def enable(enabled: bool = True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    items = key + extra
+    if len(items) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str = ""):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values = defaultdict(float)
+
+    def inc(self, amount: float = 1.0, **labels):
+        if not ENABLED:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def samples(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        for key, value in self.samples().items():
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+    def snapshot(self):
+        return [
+            {"labels": dict(key), "value": value}
+            for key, value in self.samples().items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        if not ENABLED:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str = "", buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label key -> [bucket counts..., sum, count]
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        if not ENABLED:
+            return
+        key = _label_key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            state[idx] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            return {key: list(state) for key, state in self._values.items()}
+
+    def render(self):
+        for key, state in self.samples().items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, state):
+                cumulative += n
+                le = "+Inf" if math.isinf(bound) else repr(bound)
+                yield f"{self.name}_bucket{_format_labels(key, (('le', le),))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(key)} {state[-2]}"
+            yield f"{self.name}_count{_format_labels(key)} {state[-1]}"
+
+    def snapshot(self):
+        return [
+            {
+                "labels": dict(key),
+                "buckets": [
+                    ["+Inf" if math.isinf(b) else b, n]
+                    for b, n in zip(self.buckets, state)
+                ],
+                "sum": state[-2],
+                "count": state[-1],
+            }
+            for key, state in self.samples().items()
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name: str, help: str, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            return metric
+
+    def counter(self, name: str, help: str = "") -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str = "") -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(
+        self, name: str, help: str = "", buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            if metric.help:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "mvf_stage_seconds", "Wall time spent in each pipeline stage."
+)
+STAGE_ERRORS = REGISTRY.counter(
+    "mvf_stage_errors_total", "Exceptions raised inside each pipeline stage."
+)
+ITEMS = REGISTRY.counter("mvf_items_total", "Items produced by each pipeline stage.")
+
+
+def counter(name: str, help: str = "") -> Counter:
+    return REGISTRY.counter(name, help)
+
+
+def gauge(name: str, help: str = "") -> Gauge:
+    return REGISTRY.gauge(name, help)
+
+
+def histogram(name: str, help: str = "", buckets=DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.histogram(name, help, buckets)
+
+
+def count(stage: str, amount: float = 1.0):
+    ITEMS.inc(amount, stage=stage)
+
+
+@contextmanager
+def timer(stage: str):
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def timed(stage: str):
+    """
+    Decorator version of `timer` for both plain and async functions.
+    """
+
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with timer(stage):
+                    return await fn(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int = 9464, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Expose the registry in Prometheus text format on http://host:port/metrics.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def dump_jsonl(path: str):
+    record = {"time": time.time(), "pid": os.getpid(), "metrics": REGISTRY.snapshot()}
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+class JsonlExporter(threading.Thread):
+    def __init__(self, path: str, interval: float = 10.0):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            dump_jsonl(self.path)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        dump_jsonl(self.path)
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Periodically samples the stacks of all other threads and counts them in
+    collapsed ("folded") form, readable by flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, path: str, interval: float = 0.01):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self._done = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self._done.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+                    )
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        with open(self.path, "w") as f:
+            for stack, n in sorted(self.stacks.items()):
+                f.write(f"{stack} {n}\n")
+
+
+def setup_from_env():
+    """
+    Enables metrics when METRICS is set and starts the exporters configured by
+    METRICS_PORT, METRICS_JSONL and METRICS_PROFILE. Returns the started
+    background workers so callers can stop them on exit.
+    """
+    workers = []
+    if not ENABLED:
+        return workers
+    if "METRICS_PORT" in os.environ:
+        workers.append(serve(int(os.environ["METRICS_PORT"])))
+    if "METRICS_JSONL" in os.environ:
+        exporter = JsonlExporter(
+            os.environ["METRICS_JSONL"],
+            float(os.environ.get("METRICS_JSONL_INTERVAL", 10.0)),
+        )
+        exporter.start()
+        workers.append(exporter)
+    if "METRICS_PROFILE" in os.environ:
+        profiler = SamplingProfiler(
+            os.environ["METRICS_PROFILE"],
+            float(os.environ.get("METRICS_PROFILE_INTERVAL", 0.01)),
+        )
+        profiler.start()
+        workers.append(profiler)
+    return workers
+
+
+def worker_init_fn(
+    worker_id: int, enabled: bool | None = None, path: str | None = None
+):
+    """
+    DataLoader `worker_init_fn`. Every worker process has its own REGISTRY, so
+    it gets its own JsonlExporter appending to `path` (METRICS_JSONL by
+    default); records are told apart by their pid. The exporter is stopped,
+    with a final dump, when the worker exits. `enabled` carries the parent's
+    ENABLED into workers that did not inherit it.
+    """
+    if enabled is not None:
+        enable(enabled)
+    path = path or os.environ.get("METRICS_JSONL")
+    if not ENABLED or path is None:
+        return
+    exporter = JsonlExporter(
+        path, float(os.environ.get("METRICS_JSONL_INTERVAL", 10.0))
+    )
+    exporter.start()
+    # worker processes leave through multiprocessing, which runs its
+    # finalizers but not atexit handlers
+    multiprocessing.util.Finalize(exporter, exporter.stop, exitpriority=10)
+
+
+def shutdown(workers):
+    for worker in workers:
+        if isinstance(worker, ThreadingHTTPServer):
+            worker.shutdown()
+        else:
+            worker.stop()
@@ -1,11 +1,12 @@
 from selenium import webdriver
 from selenium.webdriver.common.by import By
-import duckdb
 from tqdm.auto import tqdm
 import os
 from itertools import chain
 import re
 import numpy as np
+import metrics
+import catalog
 
 
 def get_bv(url: str):
@@ -94,45 +95,65 @@ def get_video_cards(driver: webdriver.Chrome):
 
 
 def login_videos(urls):
-    conn = duckdb.connect("bilibili.db")
-    conn.sql("CREATE SEQUENCE IF NOT EXISTS bilibili_id START WITH 1")
-    conn.sql(
-        "CREATE TABLE IF NOT EXISTS bilibili (id INTEGER NOT NULL PRIMARY KEY DEFAULT NEXTVAL('bilibili_id'), bv VARCHAR(255),  title VARCHAR(255), url VARCHAR(255), UNIQUE(bv))"
-    )
+    conn = catalog.connect("bilibili.db")
     conn.begin()
-    stmt = "INSERT INTO bilibili (bv, title, url) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING"
     driver = webdriver.Chrome()
     for url in tqdm(urls):
-        driver.get(url)
-        driver.implicitly_wait(5)
-        data = chain(
-            get_board_items(driver), get_video_cards(driver), rank_list_items(driver)
-        )
-        for bv, video_title, video_url in data:
-            conn.sql(stmt, params=(bv, video_title, video_url))
+        with metrics.timer("scrap_fetch"):
+            driver.get(url)
+            driver.implicitly_wait(5)
+        with metrics.timer("scrap_parse"):
+            data = list(
+                chain(
+                    get_board_items(driver),
+                    get_video_cards(driver),
+                    rank_list_items(driver),
+                )
+            )
+        metrics.count("scrap_parse", len(data))
+        if len(data) > 0:
+            bvs, titles, _ = zip(*data)
+            catalog.add_videos(conn, bvs, titles)
     conn.commit()
     conn.close()
     driver.close()
 
 
 def random_walk_scrap(num_walks: int = 5000):
-    conn = duckdb.connect("bilibili.db")
-    df = conn.sql("SELECT * FROM bilibili;").to_df()
-    pool = df["url"].values.tolist()
-    pool = set(pool)
-    curr_url = pool.pop()
+    conn = catalog.connect("bilibili.db")
+    # the frontier and visited sets are sorted int64 arrays of aids, 8 bytes an
+    # entry instead of a url string or boxed int in a Python set
+    pool = np.unique(catalog.video_aids(conn))
+    visited = np.empty(0, dtype=np.int64)
+    rng = np.random.default_rng()
     driver = webdriver.Chrome()
-    stmt = "INSERT INTO bilibili (bv, title, url) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING"
     for _ in tqdm(range(num_walks)):
-        driver.get(curr_url)
-        driver.implicitly_wait(5)
-        conn.begin()
-        for bv, title, url in get_related_videos(driver):
-            print(bv, url)
-            pool.add(url)
-            conn.sql(stmt, params=(bv, title, url))
-        conn.commit()
-        curr_url = pool.pop()
+        if len(pool) == 0:
+            # every related video was already visited: reseed from everything
+            # catalogued so far, and stop once that is exhausted too
+            pool = np.setdiff1d(catalog.video_aids(conn), visited)
+            if len(pool) == 0:
+                break
+        i = rng.integers(len(pool))
+        curr_aid = pool[i]
+        pool = np.delete(pool, i)
+        visited = np.insert(visited, np.searchsorted(visited, curr_aid), curr_aid)
+        with metrics.timer("scrap_fetch"):
+            driver.get(to_bilibili_url(catalog.to_bvid(int(curr_aid))))
+            driver.implicitly_wait(5)
+        with metrics.timer("scrap_parse"):
+            related = list(get_related_videos(driver))
+        metrics.count("scrap_parse", len(related))
+        if len(related) > 0:
+            bvs, titles, _ = zip(*related)
+            bvs = np.asarray(bvs)
+            aids = catalog.bvids_to_aids(bvs[catalog.is_bvid(bvs)])
+            pool = np.union1d(pool, aids[~np.isin(aids, visited)])
+            conn.begin()
+            catalog.add_videos(conn, bvs, titles)
+            conn.commit()
+    conn.close()
+    driver.close()
 
 
 def scrap(num_walks: int = 5000):
@@ -150,4 +171,6 @@ def scrap(num_walks: int = 5000):
 
 
 if __name__ == "__main__":
+    workers = metrics.setup_from_env()
     scrap(5000)
+    metrics.shutdown(workers)
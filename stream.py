@@ -7,11 +7,20 @@ import io
 
 from aiofiles import os as aioos, open as aioopen
 import os
-import duckdb
 
 import glob
-import cv2
-
+import re
+import metrics
+import concurrency
+import catalog
+
+API_ROOT = os.environ.get("BILIBILI_API_ROOT", "https://api.bilibili.com")
+VIDEO_URL = os.environ.get("BILIBILI_VIDEO_URL", "https://www.bilibili.com/video/{bvid}")
+# -352 risk control, -412 request intercepted, -799 requests too frequent
+RATE_LIMIT_CODES = (-352, -412, -799)
+# each download batch holds a single VIDEO_CDN slot, so yt-dlp opens one
+# connection per batch and the controller's in-flight count is what the CDN sees
+FRAGMENT_DOWNLOADS = 1
 
 MIXIN_KEY_TABLE = [
     46,
@@ -81,15 +90,31 @@ MIXIN_KEY_TABLE = [
 ]
 
 
+def check_response(resp: httpx.Response) -> dict:
+    """
+    Returns the JSON body, raising RateLimited if Bilibili asked us to back off.
+    """
+    retry_after = concurrency.parse_retry_after(resp.headers.get("Retry-After"))
+    if resp.status_code in (412, 429):
+        raise concurrency.RateLimited(retry_after)
+    resp.raise_for_status()
+    body = resp.json()
+    if body.get("code") in RATE_LIMIT_CODES:
+        raise concurrency.RateLimited(retry_after, body.get("message", ""))
+    return body
+
+
+@concurrency.BILIBILI_API.limited()
+@metrics.timed("api_nav")
 async def get_sessdata():
-    api_url = "http://api.bilibili.com/x/web-interface/nav"
+    api_url = f"{API_ROOT}/x/web-interface/nav"
     cookies = {
         "SESSDATA": "84b4e0f1%2C1714364387%2Cac8ab%2Ab1CjBCYFhCKr4Xec1ne49hSSMyd22JakNTXIjBOQc-egEAO2Jr_BfbHA1IzsBiC8sM0X4SVl9ybEFOcWZCbmlYX0VrUzE1ZW8zMU9KYWItTk1LTHBOSXFieXN2VV9pdUxjX3d5NTJodjE2bjk3UUdmM0s5aHdDSFlPOUNWWmxCWWZlem1BVXU1VmtBIIEC",
         "bili_jct": "8f5bf930a0a94dce6036be93d971c723",
     }
     async with httpx.AsyncClient() as client:
         resp = await client.get(api_url, cookies=cookies, follow_redirects=True)
-        wbi_img = resp.json()["data"]["wbi_img"]
+        wbi_img = check_response(resp)["data"]["wbi_img"]
         img = wbi_img["img_url"].split("/")[-1].replace(".png", "")
         sub = wbi_img["sub_url"].split("/")[-1].replace(".png", "")
         key = sub + img
@@ -102,8 +127,10 @@ async def get_sessdata():
         return params, cookies
 
 
+@concurrency.BILIBILI_API.limited()
+@metrics.timed("api_playurl")
 async def seek_stream(bvid: str, cid: str, sessdata: dict, cookies: dict, **kwargs):
-    api_url = f"https://api.bilibili.com/x/player/playurl"
+    api_url = f"{API_ROOT}/x/player/playurl"
     params = {
         "bvid": bvid,
         "cid": cid,
@@ -122,28 +149,29 @@ async def seek_stream(bvid: str, cid: str, sessdata: dict, cookies: dict, **kwar
             params=params,
             cookies=cookies,  # headers=headers
         )
-        resp.raise_for_status()
-
-        print(resp.json().keys())
-        if "data" not in resp.json():
+        body = check_response(resp)
+        if "data" not in body:
+            metrics.count("api_playurl_empty")
             return None
 
-        segments = resp.json()["data"]["dash"]["video"]
+        segments = body["data"]["dash"]["video"]
 
         return segments
 
 
+@concurrency.BILIBILI_API.limited()
+@metrics.timed("api_pagelist")
 async def get_video_info(
     bvid: str, sessdata: dict, cookies: dict, pidx: int = 0, **kwargs
 ):
-    api_url = f"https://api.bilibili.com/x/player/pagelist"
+    api_url = f"{API_ROOT}/x/player/pagelist"
     params = {"bvid": bvid, "jsonp": "jsonp", **sessdata}
     async with httpx.AsyncClient() as client:
         resp = await client.get(api_url, params=params, cookies=cookies)
-        resp.raise_for_status()
-        if "data" not in resp.json():
+        body = check_response(resp)
+        if "data" not in body:
             return None
-        pagelists = resp.json()["data"]
+        pagelists = body["data"]
         page = pagelists[pidx]
 
         return {
@@ -169,28 +197,44 @@ async def center_crop_resize(frame: Image.Image, size: int):
     return frame
 
 
+def _ydl_download(urls: list[str], ydl_opts: dict):
+    import yt_dlp
+
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl, metrics.timer("download"):
+            ydl.download(urls)
+    except yt_dlp.utils.DownloadError as e:
+        if re.search(r"HTTP Error (412|429)", str(e)):
+            raise concurrency.RateLimited(message=str(e)) from e
+        raise
+    metrics.count("download", len(urls))
+
+
 async def download_videos(
     bvids: list[str],
     data_dir: str = "data/MVFdataset/train/",
+    video_format: str = "bv[ext=mp4][height<=480]",
     **kwargs,
 ) -> bool:
-    import yt_dlp
-
-    URL = "https://www.bilibili.com/video/{bvid}"
-    urls = [URL.format(bvid=bvid) for bvid in bvids]
+    urls = [VIDEO_URL.format(bvid=bvid) for bvid in bvids]
     # Download only videos longer than a minute (or with unknown duration)
     # ℹ️ See help(yt_dlp.YoutubeDL) for a list of available options and public functions
     try:
         ydl_opts = {
-            "format": "bv[ext=mp4][height<=480]",
+            "format": video_format,
             "outtmpl": f"{data_dir}/%(webpage_url_basename)s.%(ext)s",
-            "concurrent_fragment_downloads": 16,
+            "concurrent_fragment_downloads": FRAGMENT_DOWNLOADS,
             "noplaylist": True,
             "format_sort": {"vcodec": "h265,h264,hevc,av01"},
         }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download(urls)
-            return True
+        await concurrency.VIDEO_CDN.acall(
+            asyncio.to_thread, _ydl_download, urls, ydl_opts
+        )
+        return True
+    except concurrency.RateLimited:
+        # still limited after the controller's retries: the caller must leave
+        # these bvids uncollected so a later run picks them up again
+        raise
     except Exception:
         return False
 
@@ -206,42 +250,86 @@ async def cut_video(video_path: str, image_size: int, interval: float = 5.0):
         return []
     frames = []
     for i in range(0, frame_count, frame_stride):
-        cap.set(cv2.CAP_PROP_POS_FRAMES, i)
-        ret, frame = cap.read()
+        with metrics.timer("decode"):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, i)
+            ret, frame = cap.read()
         if ret:
             frame = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            frame = await center_crop_resize(frame, image_size)
+            with metrics.timer("resize"):
+                frame = await center_crop_resize(frame, image_size)
             frames.append(frame)
+    metrics.count("decode", len(frames))
     return frames
 
 
-async def cut_videos(data_dir: str, image_size: int, interval: float = 5.0):
+def pack_frames(frames: list[Image.Image], variant_sizes=()) -> bytes:
     """
-    Returns an array of frames and a dict of video metadata
+    Encodes frames as JPEGs into an in-memory zip archive. For every size in
+    `variant_sizes` smaller than the frames, a LANCZOS-downscaled copy is
+    stored as `{size}/{i:04d}.jpeg` next to the full-size `{i:04d}.jpeg`.
     """
-    frames = []
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        for i in range(len(frames)):
+            frame = frames[i]
+            variants = [("", frame)]
+            for size in variant_sizes:
+                if size < min(frame.size):
+                    with metrics.timer("variant_resize"):
+                        small = frame.resize((size, size), Image.Resampling.LANCZOS)
+                    variants.append((f"{size}/", small))
+            for prefix, image in variants:
+                bio = io.BytesIO()
+                with metrics.timer("encode"):
+                    image.save(bio, "JPEG")
+                with metrics.timer("zip"):
+                    zf.writestr(f"{prefix}{i:04d}.jpeg", bio.getvalue())
+    return archive.getvalue()
+
+
+async def cut_videos(
+    data_dir: str,
+    image_size: int,
+    interval: float = 5.0,
+    bvids: list[str] | None = None,
+    sink=None,
+    variant_sizes=(),
+):
+    """
+    Cuts every downloaded video in `data_dir` into a zip of frames, plus
+    pre-resized copies for `variant_sizes` (see pack_frames). Archives
+    are handed to `sink` (see upload.UploadSink) when given, otherwise written
+    to `{bv}.zip` next to the video. Returns the bvids that produced an archive.
+    """
+    archived = []
     for video_name in os.listdir(data_dir):
-        bv = os.path.splitext(video_name)[0]
+        bv, ext = os.path.splitext(video_name)
+        if ext in (".zip", ".part") or (bvids is not None and bv not in bvids):
+            continue
         video_path = os.path.join(data_dir, video_name)
+        if os.path.isdir(video_path):
+            # e.g. the upload sink's spool directory
+            continue
         video_frames = await cut_video(video_path, image_size, interval)
         if len(video_frames) == 0:
             continue
-        zf_path = os.path.join(data_dir, f"{bv}.zip")
-        with zipfile.ZipFile(zf_path, "w") as zf:
-            for i in range(len(video_frames)):
-                bio = io.BytesIO()
-                frame = video_frames[i]
-                frame.save(bio, "JPEG")
-                bio.seek(0)
-                zf.writestr(f"{i:04d}.jpeg", bio.getvalue())
-    return frames
+        archive = pack_frames(video_frames, variant_sizes)
+        if sink is not None:
+            sink.submit(bv, archive)
+        else:
+            async with aioopen(os.path.join(data_dir, f"{bv}.zip"), "wb") as f:
+                await f.write(archive)
+        metrics.count("zip")
+        archived.append(bv)
+    return archived
 
 
 async def remove_cached_video(bvids: list[str], data_dir: str = "data/MVFdataset/"):
-    for bvid in glob.iglob(bvids):
-        files = glob.glob(os.path.join(data_dir, f"{bvid}.*"))
+    for bvid in bvids:
+        files = glob.glob(os.path.join(data_dir, f"{glob.escape(bvid)}.*"))
         for file in files:
-            await aioos.unlink(file)
+            if not file.endswith(".zip"):
+                await aioos.unlink(file)
 
 
 async def capture_video(
@@ -250,52 +338,41 @@ async def capture_video(
     data_dir: str = "data/MVFdataset/train/",
     interval: float = 5.0,
     image_size: int = 512,
+    sink=None,
+    variant_sizes=(),
     **kwargs,
 ):
     await aioos.makedirs(data_dir, exist_ok=True)
-    ready = await download_videos(bvids, data_dir=data_dir)
+    try:
+        ready = await download_videos(bvids, data_dir=data_dir, **kwargs)
+    except concurrency.RateLimited:
+        metrics.count("download_deferred", len(bvids))
+        await remove_cached_video(bvids, data_dir=data_dir)
+        return
+    archived = []
     if ready:
-        await cut_videos(data_dir=data_dir, image_size=image_size, interval=interval)
+        archived = await cut_videos(
+            data_dir=data_dir,
+            image_size=image_size,
+            interval=interval,
+            bvids=bvids,
+            sink=sink,
+            variant_sizes=variant_sizes,
+        )
     await remove_cached_video(bvids, data_dir=data_dir)
-    await record_done(db_path, bvids)
-
-
-async def create_bilibili_table(db_path: str):
-    conn = duckdb.connect(db_path)
-    conn.sql("CREATE SEQUENCE IF NOT EXISTS bilibili_id START WITH 1")
-    conn.sql(
-        "CREATE TABLE IF NOT EXISTS bilibili (id INTEGER NOT NULL PRIMARY KEY DEFAULT NEXTVAL('bilibili_id'), bvid VARCHAR(255),  title VARCHAR(255), url VARCHAR(255), UNIQUE(bvid))"
-    )
-    conn.commit()
-    conn.close()
-
-
-async def create_done_table(db_path: str):
-    conn = duckdb.connect(db_path)
-    conn.sql(
-        """
-    CREATE TABLE IF NOT EXISTS collected (
-        bvid VARCHAR(32) NOT NULL PRIMARY KEY,
-        cid INT,
-        signature VARCHAR(255),
-        timestamp TIMESTAMP,
-        length INT,
-        width INT,
-        height INT,
-    )
-    """
-    )
-    conn.commit()
-    conn.close()
+    if sink is not None:
+        # the sink records archived bvids itself once they are stored
+        bvids = [bvid for bvid in bvids if bvid not in archived]
+    if len(bvids) > 0:
+        await record_done(db_path, bvids)
 
 
 async def list_bvids(db_path: str):
-    conn = duckdb.connect(db_path)
-    # total = conn.sql("SELECT bv FROM bilibili").fetch_arrow_reader()
-    # done = conn.sql("SELECT bvid FROM collected").fetch_arrow_reader()
-    todo = conn.sql("SELECT bvid FROM bilibili EXCEPT SELECT bvid FROM collected")
-    while res := todo.fetchone():
-        yield res[0]
+    conn = catalog.connect(db_path)
+    todo = catalog.todo_bvids(conn)
+    conn.close()
+    for bvid in todo:
+        yield str(bvid)
 
 
 async def record_done(
@@ -303,29 +380,17 @@ async def record_done(
     bvids: list[str],
     **kwargs,
 ):
-    conn = duckdb.connect(db_path)
-    conn.sql(
-        f"INSERT INTO collected (bvid) VALUES (?) ON CONFLICT(bvid) DO NOTHING",
-        params=(bvids,),
-    )
-    conn.commit()
-    conn.close()
-
-
-async def rename_column(db_path: str):
-    conn = duckdb.connect(db_path)
-    conn.sql(
-        """
-    ALTER TABLE bilibili RENAME COLUMN bv TO bvid
-    """
-    )
-    conn.commit()
+    if len(bvids) == 0:
+        return
+    conn = catalog.connect(db_path)
+    catalog.mark_collected(conn, bvids)
     conn.close()
 
 
 async def setup(db_path: str, data_dir: str):
-    await create_bilibili_table(db_path)
-    await create_done_table(db_path)
+    # creating the catalog brings its schema up to date
+    conn = catalog.connect(db_path)
+    conn.close()
     await aioos.makedirs(data_dir, exist_ok=True)
 
 
@@ -335,28 +400,73 @@ async def main(
     username: str | None = None,
     image_size: int = 512,
     interval: float = 5.0,
+    upload_root: str | None = None,
+    sink=None,
     **kwargs,
 ):
+    """
+    Captures every bvid not yet collected. With `upload_root` (or an explicit
+    `sink`) archives are uploaded straight from memory instead of being left
+    in `data_dir` for a later upload.upload_all pass. Archives the sink could
+    not upload stay in `{data_dir}/spool` for such a pass.
+    """
     await setup(db_path, data_dir)
     username = username or "anonymous"
+    owned_sink = sink is None and upload_root is not None
+    if owned_sink:
+        import upload
+
+        # a fixed spool directory so that failed uploads can be retried with
+        # upload.upload_all(dbx, spool_dir, upload_root) after the run
+        sink = upload.UploadSink(
+            upload.get_client(),
+            upload_root,
+            db_path=db_path,
+            spool_dir=os.path.join(data_dir, "spool"),
+        )
+    # archives left in the spool by an earlier run are already captured and
+    # only wait for upload_all, so they are not downloaded again
+    spooled = set()
+    if sink is not None and os.path.isdir(sink.spool_dir):
+        spooled = {os.path.splitext(f)[0] for f in os.listdir(sink.spool_dir)}
     batch_size = 4
     bvids = []
     tasks = []
     async for bvid in list_bvids(db_path):
+        if bvid in spooled:
+            continue
         bvids.append(bvid)
         if len(bvids) == batch_size:
             coro = capture_video(
-                bvids, db_path, data_dir, interval=interval, image_size=image_size
+                bvids,
+                db_path,
+                data_dir,
+                interval=interval,
+                image_size=image_size,
+                sink=sink,
+                **kwargs,
             )
             tasks.append(coro)
             bvids = []
     if len(bvids) > 0:
         coro = capture_video(
-            bvids, db_path, data_dir, interval=interval, image_size=image_size
+            bvids,
+            db_path,
+            data_dir,
+            interval=interval,
+            image_size=image_size,
+            sink=sink,
+            **kwargs,
         )
         tasks.append(coro)
-    await asyncio.gather(*tasks)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if owned_sink:
+            await asyncio.to_thread(sink.close)
 
 
 if __name__ == "__main__":
+    workers = metrics.setup_from_env()
     asyncio.run(main("bilibili.db"))
+    metrics.shutdown(workers)
@@ -1,24 +1,43 @@
-import dropbox
-import filelock
+from __future__ import annotations
+
 import dotenv
 import os
+import posixpath
 import sys
 import tempfile
+import threading
+from typing import TYPE_CHECKING
 from tqdm.auto import tqdm
-import dropbox.files
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import duckdb
+import metrics
+import concurrency
+import catalog
+
+if TYPE_CHECKING:
+    import dropbox
+
+# heavy dependencies (dropbox, duckdb via catalog) are imported on first use so that
+# importing this module from dataset workers stays cheap
 
-dotenv.load_dotenv()
+_clients = {}
 
 
-def auth_flow() -> dropbox.Dropbox:
+def auth_flow(interactive: bool = True) -> dropbox.Dropbox:
+    import dropbox
+
+    dotenv.load_dotenv()
+    if "DBX_ACCESS_TOKEN" not in os.environ and not interactive:
+        raise KeyError(
+            "DBX_ACCESS_TOKEN is not set; run upload.auth_flow() once in a "
+            "terminal to authorize"
+        )
     if "DBX_ACCESS_TOKEN" in os.environ:
         dbx = dropbox.Dropbox(
             oauth2_refresh_token=os.environ["DBX_REFRESH_TOKEN"],
             oauth2_access_token=os.environ["DBX_ACCESS_TOKEN"],
             app_key=os.environ["DBX_APP_KEY"],
             app_secret=os.environ["DBX_APP_SECRET"],
+            max_retries_on_rate_limit=0,
         )
         return dbx
     auth_flow = dropbox.DropboxOAuth2FlowNoRedirect(
@@ -47,45 +66,89 @@ def auth_flow() -> dropbox.Dropbox:
         oauth2_access_token=os.environ["DBX_ACCESS_TOKEN"],
         app_key=os.environ["DBX_APP_KEY"],
         app_secret=os.environ["DBX_APP_SECRET"],
+        max_retries_on_rate_limit=0,
     )
     return dbx
 
 
+def get_client(interactive: bool = True) -> dropbox.Dropbox:
+    """
+    Returns this process's Dropbox client, created by `auth_flow` on first
+    use. Clients are never shared across processes, so forked workers
+    build their own instead of reusing the parent's connection pool.
+    With `interactive=False` a missing DBX_ACCESS_TOKEN raises KeyError
+    instead of prompting for an authorization code.
+    """
+    pid = os.getpid()
+    if pid not in _clients:
+        _clients[pid] = auth_flow(interactive=interactive)
+    return _clients[pid]
+
+
+def dbx_call(fn, *args, **kwargs):
+    """
+    Runs a Dropbox API call under the shared DROPBOX concurrency controller.
+    Clients are built with max_retries_on_rate_limit=0 so rate limits surface
+    here instead of being slept on inside the SDK.
+    """
+
+    import dropbox.exceptions
+
+    def call():
+        try:
+            return fn(*args, **kwargs)
+        except dropbox.exceptions.RateLimitError as e:
+            raise concurrency.RateLimited(e.backoff) from e
+
+    return concurrency.DROPBOX.call(call)
+
+
+@metrics.timed("dbx_download")
 def download_file(
     dbx: dropbox.Dropbox, local_path: str, remote_path: str, pbar: tqdm = None
 ):
-    dbx.files_download_to_file(local_path, remote_path)
+    dbx_call(dbx.files_download_to_file, local_path, remote_path)
     if pbar is not None:
         pbar.update()
         pbar.set_description(f"Downloaded: {os.path.basename(local_path)}")
 
 
+@metrics.timed("upload")
 def upload_file(
     dbx: dropbox.Dropbox, local_path: str, remote_path: str, pbar: tqdm = None
 ):
+    import dropbox.files
+
+    def read_and_upload():
+        # read inside the DROPBOX slot so threads waiting for one do not each
+        # hold a whole archive in memory
+        with open(local_path, "rb") as f:
+            data = f.read()
+        return dbx.files_upload(
+            data, remote_path, mode=dropbox.files.WriteMode.overwrite
+        )
+
     # dbx.check_and_refresh_access_token()
-    dbx.files_upload(
-        open(local_path, "rb").read(),
-        remote_path,
-        mode=dropbox.files.WriteMode.overwrite,
-    )
+    dbx_call(read_and_upload)
     if pbar is not None:
         pbar.update()
         pbar.set_description(f"Uploaded: {os.path.basename(local_path)}")
 
 
+@metrics.timed("list")
 def list_exists(dbx: dropbox.Dropbox, remote_root: str, extension: str = ".zip"):
     filenames = []
-    resp = dbx.files_list_folder(remote_root)
+    resp = dbx_call(dbx.files_list_folder, remote_root)
     while True:
         filenames += [entry.name for entry in resp.entries]
         if resp.has_more:
-            resp = dbx.files_list_folder_continue(resp.cursor)
+            resp = dbx_call(dbx.files_list_folder_continue, resp.cursor)
         else:
             break
     return filenames
 
 
+@metrics.timed("upload")
 def upload_file2(
     dbx: dropbox.Dropbox,
     local_path: str,
@@ -93,11 +156,15 @@ def upload_file2(
     chunk_size: int = 4 * 1024 * 1024,
     pbar: tqdm = None,
 ):
+    import dropbox.files
+
     # dbx.check_and_refresh_access_token()
     with open(local_path, "rb") as f:
         filesize = os.path.getsize(local_path)
         chunk_size = min(chunk_size, filesize)
-        upload_session_start_result = dbx.files_upload_session_start(f.read(chunk_size))
+        upload_session_start_result = dbx_call(
+            dbx.files_upload_session_start, f.read(chunk_size)
+        )
         cursor = dropbox.files.UploadSessionCursor(
             session_id=upload_session_start_result.session_id,
             offset=f.tell(),
@@ -105,13 +172,16 @@ def upload_file2(
         commit = dropbox.files.CommitInfo(path=remote_path)
         while f.tell() < filesize:
             if (filesize - f.tell()) <= chunk_size:
-                res = dbx.files_upload_session_finish(
-                    f.read(chunk_size), cursor, commit
+                res = dbx_call(
+                    dbx.files_upload_session_finish, f.read(chunk_size), cursor, commit
                 )
                 print(f"Uploaded {os.path.basename(local_path)}")
             else:
-                dbx.files_upload_session_append(
-                    f.read(chunk_size), cursor.session_id, cursor.offset
+                dbx_call(
+                    dbx.files_upload_session_append,
+                    f.read(chunk_size),
+                    cursor.session_id,
+                    cursor.offset,
                 )
                 cursor.offset = f.tell()
 
@@ -121,20 +191,29 @@ def upload_file2(
     return True
 
 
+def record_collected(db_path: str, bvids):
+    bvids = list(bvids)
+    if len(bvids) == 0:
+        return
+    conn = catalog.connect(db_path)
+    catalog.mark_collected(conn, bvids)
+    conn.close()
+
+
 def upload_all(
     dbx: dropbox.Dropbox,
     local_root: str,
     remote_root: str,
-    num_threads=16,
+    num_threads: int | None = None,
+    db_path: str = "bilibili.db",
 ):
     # dbx.check_and_refresh_access_token()
     existed = set(
         os.path.splitext(os.path.basename(f))[0] for f in list_exists(dbx, remote_root)
     )
-    conn = duckdb.connect("bilibili.db")
-    conn.sql("INSERT INTO collected (bvid) VALUES (?)", params=(list(existed),))
-    conn.commit()
-    conn.close()
+    record_collected(db_path, existed)
+    # the DROPBOX controller decides how many of these are actually in flight
+    num_threads = num_threads or concurrency.DROPBOX.maximum
     with ThreadPoolExecutor(num_threads) as executor:
         files = os.listdir(local_root)
         pbar = tqdm(total=len(files), leave=False)
@@ -158,23 +237,138 @@ def upload_all(
                 pbar.update()
         for f in as_completed(futures):
             if f.exception() is not None:
-                pass
+                tqdm.write(f"Upload failed: {f.exception()!r}", file=sys.stderr)
+            else:
+                metrics.count("upload")
 
         executor.shutdown(wait=True)
         pbar.close()
 
 
+class UploadSink:
+    """
+    Takes archives from the capture pipeline and uploads them straight from
+    memory on a thread pool, recording each bvid in `collected` once it is
+    stored. While more than `max_buffer` bytes are waiting for upload, new
+    archives are spooled to `spool_dir` instead and read back by the workers.
+    Archives that fail to upload are left in `spool_dir` so a later
+    `upload_all(dbx, spool_dir, remote_root)` can retry them.
+    """
+
+    def __init__(
+        self,
+        dbx: dropbox.Dropbox,
+        remote_root: str,
+        db_path: str = "bilibili.db",
+        num_threads: int | None = None,
+        max_buffer: int = 256 * 1024 * 1024,
+        spool_dir: str | None = None,
+    ):
+        self.dbx = dbx
+        self.remote_root = remote_root
+        self.db_path = db_path
+        self.max_buffer = max_buffer
+        self.spool_dir = spool_dir or tempfile.mkdtemp(prefix="mvf-spool-")
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.buffered = 0
+        self.failed = []
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._futures = []
+        self._executor = ThreadPoolExecutor(
+            num_threads or concurrency.DROPBOX.maximum
+        )
+
+    def submit(self, bvid: str, data: bytes):
+        with self._lock:
+            spool = self.buffered + len(data) > self.max_buffer
+            if not spool:
+                self.buffered += len(data)
+        if spool:
+            with metrics.timer("spool"):
+                path = self._spool(bvid, data)
+            future = self._executor.submit(self._upload_spooled, bvid, path)
+        else:
+            future = self._executor.submit(self._upload, bvid, data)
+        self._futures.append(future)
+        return future
+
+    def _spool(self, bvid: str, data: bytes) -> str:
+        path = os.path.join(self.spool_dir, f"{bvid}.zip")
+        with open(path, "wb") as f:
+            f.write(data)
+        metrics.count("spool")
+        return path
+
+    def _upload(self, bvid: str, data: bytes):
+        try:
+            self._store(bvid, lambda: data)
+        except Exception:
+            self._spool(bvid, data)
+            raise
+        finally:
+            with self._lock:
+                self.buffered -= len(data)
+
+    def _upload_spooled(self, bvid: str, path: str):
+        def read():
+            with open(path, "rb") as f:
+                return f.read()
+
+        self._store(bvid, read)
+        os.unlink(path)
+
+    def _store(self, bvid: str, read):
+        """
+        Uploads the archive returned by `read`, which is only called once a
+        DROPBOX slot is held so spooled archives stay on disk while queued.
+        """
+        import dropbox.files
+
+        remote_path = posixpath.join(self.remote_root, f"{bvid}.zip")
+
+        def read_and_upload():
+            return self.dbx.files_upload(
+                read(), remote_path, mode=dropbox.files.WriteMode.overwrite
+            )
+
+        with metrics.timer("upload"):
+            dbx_call(read_and_upload)
+        metrics.count("upload")
+        with self._db_lock:
+            record_collected(self.db_path, [bvid])
+
+    def close(self):
+        for future in as_completed(self._futures):
+            if future.exception() is not None:
+                self.failed.append(future)
+                tqdm.write(f"Upload failed: {future.exception()!r}", file=sys.stderr)
+        self._executor.shutdown(wait=True)
+        if len(os.listdir(self.spool_dir)) == 0:
+            os.rmdir(self.spool_dir)
+        elif len(self.failed) > 0:
+            tqdm.write(f"Failed uploads kept in {self.spool_dir}", file=sys.stderr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@metrics.timed("dbx_download")
 def download(dbx: dropbox.Dropbox, local_path: str, remote_path: str):
-    metadata, response = dbx.files_download(remote_path)
+    metadata, response = dbx_call(dbx.files_download, remote_path)
     with open(local_path, "wb") as f:
         f.write(response.content)
 
 
 if __name__ == "__main__":
-    dbx = auth_flow()
+    workers = metrics.setup_from_env()
+    dbx = get_client()
     upload_all(
         dbx,
         local_root="/home/zc2309/workspace/scrap_bilibili/data/MVFdataset/train",
         remote_root="/MVFdataset/",
-        num_threads=16,
     )
+    metrics.shutdown(workers)
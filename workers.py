@@ -0,0 +1,26 @@
+import multiprocessing as mp
+
+# modules every dataset or capture worker ends up importing
+PRELOAD = (
+    "metrics",
+    "concurrency",
+    "upload",
+    "dataset",
+    "torch",
+    "torchvision.transforms.v2.functional",
+    "PIL.Image",
+    "dropbox",
+)
+
+
+def forkserver_context(preload=PRELOAD):
+    """
+    Returns a forkserver multiprocessing context whose server imports
+    `preload` once, so new workers fork from that warm template instead of
+    re-importing everything. Modules that fail to import are skipped by the
+    forkserver. The preload list only takes effect before the forkserver
+    has started.
+    """
+    ctx = mp.get_context("forkserver")
+    ctx.set_forkserver_preload(list(preload))
+    return ctx